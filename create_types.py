@@ -1,11 +1,13 @@
 import os
-import json
-import re
-import math
 import numpy as np
-import matplotlib.pyplot as plt
-from collections import defaultdict, Counter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
+from matplotlib.colors import to_rgb, to_rgba
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm  # Progress bar for file processing
+from pages_index import ZONE_TYPE_NAMES, build_century_pages
 
 # ---------------------------
 # CONFIGURATION
@@ -22,6 +24,8 @@ ZONE_COLORS = {
     "DefaultLine": "purple",
     "Other": "gray"  # fallback for unknown types
 }
+# Same colors indexed by zone type code (see pages_index.ZONE_TYPE_CODES)
+COLOR_LIST = [ZONE_COLORS[ztype] for ztype in ZONE_TYPE_NAMES]
 
 # Maximum alpha (opacity) and linewidth for rectangle edges
 ALPHA_MAX = 0.3 #
@@ -31,163 +35,175 @@ LW_MIN = 0.0001  # 0.001
 # Exponential decay coefficient: controls how alpha & linewidth decrease with frequency
 EXP_COEFF = 2.0
 
+# Reuse the pages parsed by a previous run when no JSON file has changed since
+USE_CACHE = True
+
+# Number of worker processes reading the JSON files and rendering the overlay images
+MAX_WORKERS = os.cpu_count()
+
+# Resolution of the saved overlay images
+DPI = 200
+
+# Figures with more zones than this are blended into a pixel canvas shown with imshow
+# instead of drawing one vector rectangle per zone (only faster on dense centuries)
+RASTERIZE_MIN_ZONES = 20_000
+
 # ---------------------------
 # FUNCTIONS
 # ---------------------------
-def year_to_century(year_raw):
+def outline_coverage(xywh, width, height):
     """
-    Convert a raw start_year value into the corresponding century.
-    - If year < 100, assume it is 1-based and add 1
-    - Otherwise, integer division by 100 + 1
+    Rasterize rectangle outlines onto a width x height pixel grid.
+    xywh holds one (x, y, w, h) rectangle per row, in pixel units.
+    Returns an int array giving, for each pixel, the number of outlines covering it.
+    Edges lying outside the grid are not drawn:
+
+    >>> int(outline_coverage(np.array([[2., 50., 5., 5.], [-30., 2., 5., 5.]]), 10, 10).sum())
+    0
+    >>> outline_coverage(np.array([[-1., -1., 3., 3.]]), 4, 4).tolist()
+    [[0, 1, 0, 0], [1, 1, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
     """
-    if year_raw is None:
-        return None
-    s = str(year_raw).strip()
-    match = re.match(r"(\d+)", s)
-    if match:
-        year = int(match.group(1))
-        if year < 100:
-            return year + 1
-        else:
-            return (year // 100) + 1
-    return None
-
-def list_all_json_files(base_dir):
+    # Pixel positions of the left, bottom, right and top edges, before any clamping
+    xa = np.floor(xywh[:, 0]).astype(np.intp)
+    ya = np.floor(xywh[:, 1]).astype(np.intp)
+    xb = np.maximum(np.ceil(xywh[:, 0] + xywh[:, 2]).astype(np.intp) - 1, xa)
+    yb = np.maximum(np.ceil(xywh[:, 1] + xywh[:, 3]).astype(np.intp) - 1, ya)
+    # Drop the rectangles that do not overlap the grid at all
+    overlap = (xb >= 0) & (xa < width) & (yb >= 0) & (ya < height)
+    xa, ya, xb, yb = xa[overlap], ya[overlap], xb[overlap], yb[overlap]
+
+    # Each edge is stored as a +1/-1 pair and expanded with a cumulative sum,
+    # so the cost depends on the number of rectangles, not on their size.
+    # Only the span of an edge is clamped; an edge outside the grid is skipped.
+    rows = np.zeros((height, width + 1), dtype=np.int32)
+    x_start, x_end = np.maximum(xa, 0), np.minimum(xb, width - 1)
+    for y, keep in ((ya, ya >= 0), (yb, (yb < height) & (yb > ya))):  # bottom and top edges
+        np.add.at(rows, (y[keep], x_start[keep]), 1)
+        np.add.at(rows, (y[keep], x_end[keep] + 1), -1)
+    cols = np.zeros((height + 1, width), dtype=np.int32)
+    y_start, y_end = np.maximum(ya + 1, 0), np.minimum(yb - 1, height - 1)
+    spans = y_start <= y_end  # left and right edges, without the corners drawn above
+    for x, keep in ((xa, spans & (xa >= 0)), (xb, spans & (xb < width) & (xb > xa))):
+        np.add.at(cols, (y_start[keep], x[keep]), 1)
+        np.add.at(cols, (y_end[keep] + 1, x[keep]), -1)
+
+    return rows.cumsum(axis=1, dtype=np.int32)[:, :width] + cols.cumsum(axis=0, dtype=np.int32)[:height]
+
+def render_overlay(century, orientation, pages):
     """
-    Recursively collect all JSON files in a directory and its subdirectories.
-    Returns a list of full file paths.
+    Draw the overlay "page type" of one century and orientation and save it as PNG.
+    Returns the path of the saved image.
     """
-    files_list = []
-    for root, _, files in os.walk(base_dir):
-        for f in files:
-            if f.endswith(".json"):
-                files_list.append(os.path.join(root, f))
-    return files_list
-
-# ---------------------------
-# STEP 1: Collect page and zone info per century & orientation
-# ---------------------------
-
-# Dictionary structure: century -> {"portrait": [...], "landscape": [...]}
-century_pages = defaultdict(lambda: {"portrait": [], "landscape": []})
-
-# Collect all JSON files recursively
-all_files = list_all_json_files(BASE_DIR)
-print(f"Total JSON files found: {len(all_files)}")
-
-# Iterate over all files with a progress bar
-for filepath in tqdm(all_files, desc="Reading JSON files"):
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            doc = json.load(f)
-    except Exception as e:
-        print(f"Error reading {filepath}: {e}")
-        continue
-
-    # Determine the century of the document
-    century = year_to_century(doc.get("start_year"))
-    if century is None:
-        continue
-
-    # Iterate over all pages in the document
-    for file_entry in doc.get("files", []):
-        wh_page = file_entry.get("wh", [1000, 1000])  # default width/height if missing
-        if len(wh_page) != 2 or wh_page[0] == 0 or wh_page[1] == 0:
-            continue
-
-        # Determine page orientation
-        orientation = "landscape" if wh_page[0] > wh_page[1] else "portrait"
-
-        # Collect all zones for the page
-        page_zones = []
-        for zone in file_entry.get("zones", []):
-            xy = zone.get("xy", [0, 0])  # top-left corner coordinates
-            wh = zone.get("wh", [0, 0])  # width & height
-            ztype = zone.get("type", "Other")  # zone type, default to "Other"
-
-            # Validate coordinates and dimensions
-            if len(xy) == 2 and len(wh) == 2 and wh[0] > 0 and wh[1] > 0:
-                page_zones.append({
-                    "x": xy[0],
-                    "y": xy[1],
-                    "w": wh[0],
-                    "h": wh[1],
-                    "type": ztype
-                })
-
-        # Add the page data to the corresponding century and orientation
-        if page_zones:
-            century_pages[century][orientation].append({
-                "page_wh": wh_page,
-                "zones": page_zones
-            })
-
-# ---------------------------
-# STEP 2: Draw overlay "page type" per century and orientation
-# ---------------------------
-
-for century in tqdm(century_pages.keys(), desc="Generating overlay pages"):
-    for orientation in ["portrait", "landscape"]:
-        pages = century_pages[century][orientation]
-        if not pages:
-            continue
-
-        # Compute average page size for normalization/scaling
-        avg_w = np.mean([p["page_wh"][0] for p in pages])
-        avg_h = np.mean([p["page_wh"][1] for p in pages])
-
-        # Create figure with scaled size
-        fig, ax = plt.subplots(figsize=(avg_w/200, avg_h/200))
-        ax.set_xlim(0, avg_w)
-        ax.set_ylim(0, avg_h)
-        ax.set_title(f"Representative Page Overlay - Century {century} ({orientation})")
-        ax.set_aspect("equal")
-        ax.axis("off")  # hide axes
-
-        # Count how many times each zone type occurs (for dynamic alpha/linewidth)
-        zone_type_counts = Counter(z["type"] for p in pages for z in p["zones"])
-        max_count = max(zone_type_counts.values()) if zone_type_counts else 1
-
-        # Draw all zones with scaling applied
-        for page in pages:
-            w_page, h_page = page["page_wh"]
-            scale_x = avg_w / w_page
-            scale_y = avg_h / h_page
-
-            for z in page["zones"]:
-                rect_x = z["x"] * scale_x
-                rect_y = z["y"] * scale_y
-                rect_w = z["w"] * scale_x
-                rect_h = z["h"] * scale_y
-                zone_type = z["type"]
-
-                freq = zone_type_counts[zone_type]
-
-                # Exponential/logarithmic scaling:
-                # - zones that appear frequently become more transparent and thinner
-                alpha = ALPHA_MAX * math.exp(-EXP_COEFF * freq / max_count)
-                linewidth = max(LW_MIN, LW_MAX * math.exp(-EXP_COEFF * freq / max_count))
-
-                # Draw rectangle with edge color corresponding to zone type
-                ax.add_patch(
-                    plt.Rectangle(
-                        (rect_x, rect_y),
-                        rect_w,
-                        rect_h,
-                        edgecolor=ZONE_COLORS.get(zone_type, "gray"),
-                        facecolor="none",
-                        linewidth=linewidth,
-                        alpha=alpha
-                    )
+    # Compute average page size for normalization/scaling
+    page_whs = np.array([p["page_wh"] for p in pages], dtype=np.float64)
+    avg_w, avg_h = page_whs.mean(axis=0)
+
+    # Create figure with scaled size, rendered directly by the Agg canvas (no pyplot)
+    fig = Figure(figsize=(avg_w/DPI, avg_h/DPI))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_xlim(0, avg_w)
+    ax.set_ylim(0, avg_h)
+    ax.set_title(f"Representative Page Overlay - Century {century} ({orientation})")
+    ax.set_aspect("equal")
+    ax.axis("off")  # hide axes
+
+    # Count how many times each zone type occurs (for dynamic alpha/linewidth)
+    type_codes = np.concatenate([p["type_codes"] for p in pages])
+    zone_type_counts = np.bincount(type_codes, minlength=len(ZONE_TYPE_NAMES))
+    max_count = zone_type_counts.max() if zone_type_counts.any() else 1
+
+    # Alpha and linewidth only depend on the zone type, so compute them once per type.
+    # Exponential/logarithmic scaling:
+    # - zones that appear frequently become more transparent and thinner
+    decay = np.exp(-EXP_COEFF * zone_type_counts / max_count)
+    alphas = (ALPHA_MAX * decay).tolist()
+    linewidths = np.maximum(LW_MIN, LW_MAX * decay).tolist()
+    style = {
+        code: (alphas[code], linewidths[code])
+        for code in np.flatnonzero(zone_type_counts).tolist()
+    }
+
+    # Scale all zones of each page to the average page size in one multiplication
+    scales = np.tile(np.array([avg_w, avg_h]) / page_whs, 2)
+    scaled = np.concatenate([p["xywh"] * scale for p, scale in zip(pages, scales)])
+
+    if len(scaled) > RASTERIZE_MIN_ZONES:
+        # One canvas pixel per pixel of the axes area in the saved image, so that the
+        # canvas is not resampled, on a white background
+        ax.apply_aspect()
+        box = ax.get_window_extent()
+        width = max(1, round(box.width * DPI / fig.dpi))
+        height = max(1, round(box.height * DPI / fig.dpi))
+        pixels = scaled * np.array([width / avg_w, height / avg_h] * 2, dtype=np.float32)
+        canvas = np.ones((height, width, 3), dtype=np.float32)
+        # Zone types are blended one after the other: n outlines of the same color
+        # and alpha leave (1 - alpha) ** n of what was below them
+        for code, (alpha, linewidth) in style.items():
+            coverage = outline_coverage(pixels[type_codes == code], width, height)
+            # Lines thinner than a pixel only partially cover it
+            alpha *= min(1.0, linewidth * DPI / 72)
+            keep = np.power(np.float32(1 - alpha), coverage, dtype=np.float32)[..., None]
+            color = np.array(to_rgb(COLOR_LIST[code]), dtype=np.float32)
+            # canvas * keep + color * (1 - keep), computed in place
+            canvas -= color
+            canvas *= keep
+            canvas += color
+        # Hand the canvas over as 8-bit RGBA: matplotlib resamples float or RGB images
+        # through several float64 copies of the full canvas
+        canvas *= 255
+        canvas += 0.5
+        image = np.full((height, width, 4), 255, dtype=np.uint8)
+        image[..., :3] = canvas
+        ax.imshow(image, extent=(0, avg_w, 0, avg_h), origin="lower", interpolation="nearest")
+    else:
+        # Draw each zone type as a single collection instead of one artist per rectangle,
+        # with edge color corresponding to zone type
+        for code, (alpha, linewidth) in style.items():
+            ax.add_collection(
+                PatchCollection(
+                    [Rectangle((x, y), w, h) for x, y, w, h in scaled[type_codes == code]],
+                    edgecolors=to_rgba(COLOR_LIST[code], alpha),
+                    facecolors="none",
+                    linewidths=linewidth
                 )
-
-        # Add a legend showing which color corresponds to which zone type
-        for ztype, color in ZONE_COLORS.items():
-            ax.plot([], [], color=color, label=ztype, linewidth=2)
-        ax.legend(loc="upper right", fontsize=8)
-
-        # Save figure to output folder
-        fig_path = os.path.join(OUTPUT_FOLDER, f"page_type_overlay_century_{century}_{orientation}.png")
-        plt.savefig(fig_path, dpi=200, bbox_inches="tight")
-        plt.close(fig)
-        print(f"✅ Saved overlay page type for century {century} ({orientation}): {fig_path}")
\ No newline at end of file
+            )
+
+    # Add a legend showing which color corresponds to which zone type
+    for ztype, color in ZONE_COLORS.items():
+        ax.plot([], [], color=color, label=ztype, linewidth=2)
+    ax.legend(loc="upper right", fontsize=8)
+
+    # Save figure to output folder
+    fig_path = os.path.join(OUTPUT_FOLDER, f"page_type_overlay_century_{century}_{orientation}.png")
+    fig.savefig(fig_path, dpi=DPI, bbox_inches="tight")
+    return fig_path
+
+if __name__ == "__main__":
+    # ---------------------------
+    # STEP 1: Collect page and zone info per century & orientation
+    # ---------------------------
+
+    # Parsed in parallel, or loaded from the cache of a previous run
+    century_pages = build_century_pages(BASE_DIR, use_cache=USE_CACHE, max_workers=MAX_WORKERS)
+
+    # ---------------------------
+    # STEP 2: Draw overlay "page type" per century and orientation
+    # ---------------------------
+
+    # One figure per (century, orientation) with pages, rendered in parallel
+    keys = [
+        (century, orientation)
+        for century in century_pages
+        for orientation in ["portrait", "landscape"]
+        if century_pages[century][orientation]
+    ]
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        fig_paths = ex.map(
+            render_overlay,
+            [century for century, _ in keys],
+            [orientation for _, orientation in keys],
+            [century_pages[century][orientation] for century, orientation in keys]
+        )
+        for (century, orientation), fig_path in tqdm(zip(keys, fig_paths), total=len(keys), desc="Generating overlay pages"):
+            print(f"✅ Saved overlay page type for century {century} ({orientation}): {fig_path}")
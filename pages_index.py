@@ -0,0 +1,249 @@
+import json
+import mmap
+import os
+import pickle
+import re
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tqdm import tqdm  # Progress bar for file processing
+
+try:
+    import orjson  # Much faster JSON parser
+except ImportError:
+    orjson = None  # Fall back to the standard json module
+
+# ---------------------------
+# CONFIGURATION
+# ---------------------------
+
+# Compact integer code for each zone type; zones are stored with these codes,
+# and any type missing from this table is stored as "Other"
+ZONE_TYPE_CODES = {"MainZone": 0, "MarginTextZone": 1, "DropCapitalZone": 2, "DefaultLine": 3, "Other": 4}
+ZONE_TYPE_NAMES = list(ZONE_TYPE_CODES)
+
+# Number of worker processes, and of files handed to each worker at once, when reading JSON in parallel
+MAX_WORKERS = os.cpu_count()
+CHUNKSIZE = 32
+
+# JSON files larger than this (in bytes) are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 1 << 20
+
+# Number of files the kernel is asked to start reading ahead of the workers
+READAHEAD = 1024
+
+# Version of the data stored by parse_json_file: bump it when the parsing rules change,
+# so that caches written by an older version are rebuilt
+CACHE_FORMAT = 1
+
+# Leading digits of a start_year, compiled once at import time
+_YEAR_RE = re.compile(r"(\d+)")
+
+# ---------------------------
+# FUNCTIONS
+# ---------------------------
+def year_to_century(year_raw):
+    """
+    Convert a raw start_year value into the corresponding century.
+    - If year < 100 (partial year such as 12 or "7..."), assume it is 1-based and add 1
+    - Otherwise, integer division by 100 + 1
+    Returns None if the year is invalid.
+    """
+    if year_raw is None:
+        return None
+    if type(year_raw) is int and year_raw >= 0:
+        year = year_raw  # Fast path: start_year is usually already an integer
+    else:
+        s = year_raw if isinstance(year_raw, str) else str(year_raw)
+        match = _YEAR_RE.match(s.strip())
+        if not match:
+            return None
+        year = int(match.group(1))
+    if year < 100:
+        return year + 1
+    else:
+        return (year // 100) + 1
+
+def load_json(filepath):
+    """
+    Parse a JSON file with orjson (or the json module if orjson is not installed).
+    Files larger than MMAP_THRESHOLD are memory-mapped and parsed in place,
+    without first copying their content into a bytes object.
+    """
+    if orjson is None:
+        with open(filepath, "rb") as f:
+            return json.load(f)
+
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+                return orjson.loads(buf)
+        return orjson.loads(f.read())
+
+def json_executor(max_workers=MAX_WORKERS):
+    """
+    Return the pool used to parse JSON files in parallel.
+    orjson and the Python code walking the documents hold the GIL, so threads only run
+    in parallel on a free-threaded Python build: use them there (results are then not
+    pickled between processes), and processes everywhere else.
+    """
+    if hasattr(sys, "_is_gil_enabled") and not sys._is_gil_enabled():
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+def readahead(filepath):
+    """
+    Ask the kernel to start loading a file into the page cache (posix_fadvise WILLNEED)
+    and return immediately. Does nothing where posix_fadvise is not available.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return  # Reported by the worker when it reads the file
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def with_readahead(results, paths, ahead=READAHEAD):
+    """
+    Yield results (one per path, in the same order) while asking the kernel to read
+    the file `ahead` positions further, so disk reads overlap with the parsing done
+    by the workers instead of each worker waiting on its own read.
+    """
+    for path in paths[:ahead]:
+        readahead(path)
+    for i, result in enumerate(results):
+        if i + ahead < len(paths):
+            readahead(paths[i + ahead])
+        yield result
+
+def list_all_json_files(base_dir):
+    """
+    Recursively yield all JSON files in a directory and its subdirectories.
+    Walks the tree with os.scandir: DirEntry caches the file type and the full path,
+    so no extra stat or os.path.join is needed per file.
+    """
+    stack = [base_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    yield entry.path
+
+def parse_json_file(filepath):
+    """
+    Read a single JSON file and extract its pages with their zones.
+    Returns (century, [(orientation, page), ...]) or None if the file
+    cannot be read or start_year is invalid.
+    """
+    try:
+        doc = load_json(filepath)
+    except (OSError, json.JSONDecodeError, UnicodeDecodeError) as e:
+        print(f"Error reading {filepath}: {e}")
+        return None
+
+    # Determine the century of the document
+    century = year_to_century(doc.get("start_year"))
+    if century is None:
+        return None
+
+    pages = []
+    # Iterate over all pages in the document
+    for file_entry in doc.get("files", []):
+        wh_page = file_entry.get("wh", [1000, 1000])  # default width/height if missing
+        if len(wh_page) != 2 or wh_page[0] == 0 or wh_page[1] == 0:
+            continue
+
+        # Determine page orientation
+        orientation = "landscape" if wh_page[0] > wh_page[1] else "portrait"
+
+        # Collect all zones for the page
+        page_xywh = []
+        page_types = []
+        for zone in file_entry.get("zones", []):
+            xy = zone.get("xy", [0, 0])  # top-left corner coordinates
+            wh = zone.get("wh", [0, 0])  # width & height
+            ztype = ZONE_TYPE_CODES.get(zone.get("type"), ZONE_TYPE_CODES["Other"])  # zone type code
+
+            # Validate coordinates and dimensions
+            if len(xy) == 2 and len(wh) == 2 and wh[0] > 0 and wh[1] > 0:
+                page_xywh.append((xy[0], xy[1], wh[0], wh[1]))
+                page_types.append(ztype)
+
+        # Store the zones as arrays: one (x, y, w, h) row per zone and the matching type codes
+        if page_xywh:
+            pages.append((orientation, {
+                "page_wh": wh_page,
+                "xywh": np.array(page_xywh, dtype=np.float32),
+                "type_codes": np.array(page_types, dtype=np.int8)
+            }))
+
+    return century, pages
+
+def latest_mtime(base_dir):
+    """
+    Return the most recent modification time of the JSON files and folders under base_dir.
+    Folders are included so that deleted or added files are also noticed.
+    """
+    latest = os.stat(base_dir).st_mtime
+    stack = [base_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime)
+                elif entry.name.endswith(".json"):
+                    latest = max(latest, entry.stat().st_mtime)
+    return latest
+
+def build_century_pages(base_dir, use_cache=True, max_workers=MAX_WORKERS):
+    """
+    Collect page and zone info per century & orientation for all JSON files under base_dir,
+    parsed by max_workers workers.
+    Returns a dict: century -> {"portrait": [page, ...], "landscape": [page, ...]}
+
+    The result is cached in "<base_dir>.cache.pkl" and reused as long as the cache
+    is newer than every JSON file and folder under base_dir, and was written with
+    the same CACHE_FORMAT and zone types.
+    """
+    cache_path = f"{os.path.normpath(base_dir)}.cache.pkl"
+    # The type_codes stored in the cache depend on the parsing rules and on ZONE_TYPE_CODES
+    cache_key = (CACHE_FORMAT, ZONE_TYPE_NAMES)
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) > latest_mtime(base_dir):
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        # A cache written with another format or other zone types is ignored and rebuilt
+        if isinstance(cached, dict) and cached.get("key") == cache_key:
+            print(f"Loading pages from cache: {cache_path}")
+            return cached["century_pages"]
+
+    # Dictionary structure: century -> {"portrait": [...], "landscape": [...]}
+    century_pages = {}
+
+    # Collect all JSON files recursively
+    all_files = list(list_all_json_files(base_dir))
+    print(f"Total JSON files found: {len(all_files)}")
+
+    # Parse files in parallel, then merge the pages into century_pages
+    with json_executor(max_workers) as ex:
+        results = with_readahead(ex.map(parse_json_file, all_files, chunksize=CHUNKSIZE), all_files)
+        for result in tqdm(results, total=len(all_files), desc="Reading JSON files", mininterval=0.5):
+            if result is None:
+                continue
+            century, pages = result
+            # Add the page data to the corresponding century and orientation
+            orientations = century_pages.setdefault(century, {"portrait": [], "landscape": []})
+            for orientation, page in pages:
+                orientations[orientation].append(page)
+
+    if use_cache:
+        with open(cache_path, "wb") as f:
+            pickle.dump({"key": cache_key, "century_pages": century_pages}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return century_pages
@@ -1,10 +1,12 @@
 import os
+import ijson
 import json
 import re
 import numpy as np
+from numpy.polynomial import polynomial as P, polyutils as pu
 import pandas as pd
-import matplotlib.pyplot as plt
 from tqdm import tqdm
+from pages_index import json_executor, latest_mtime, list_all_json_files, load_json, with_readahead, year_to_century
 
 # ---------------------------
 # BASE CONFIGURATION
@@ -13,217 +15,266 @@ BASE_DIR = "batch"  # Root folder containing subfolders with JSON files
 CSV_OUTPUT = "data.csv"
 FIGURE_OUTPUT = "graph.png"
 POLY_DEGREE = 6  # Degree of polynomial for smoothing
+METRICS = ["mainzone", "margin", "graphic", "total", "tokens"]  # Per-file averages returned by process_json_file
 SAVE_CSV = False   # Set to False to skip saving CSV
+PLOT_FIGURE = True  # Set to False to skip the smoothing and the figure (matplotlib is then not imported)
+USE_CACHE = True  # Reuse the per-file averages saved by a previous run while the JSON files are unchanged
+CACHE_FORMAT = 1  # Bump when process_json_file or aggregate_pages change how the averages are computed
+MAX_WORKERS = os.cpu_count()  # Number of worker processes reading the JSON files
+CHUNKSIZE = 32  # Number of files handed to each worker at once
+STREAM_THRESHOLD = 4 * 1024 * 1024  # JSON files larger than this (in bytes) are streamed with ijson
+
+# Regular expression, compiled once at import time
+_TOKEN_RE = re.compile(r"\w+")
 
 # ---------------------------
 # FUNCTION DEFINITIONS
 # ---------------------------
 
-def year_to_century(year_raw):
+def tokenize(text):
     """
-    Convert a raw 'start_year' value to a century.
-    Rules:
-    - Full year (e.g., 843) => century = (year // 100) + 1
-    - 1-2 digit year (partial, e.g., 12, 7) or with punctuation (12.., 7...) => century = int(year) + 1
-    - Returns None if the year is invalid
+    Simple tokenizer: split text into alphanumeric tokens.
     """
-    if year_raw is None:
-        return None
+    return _TOKEN_RE.findall(text) if text else []
 
-    s = str(year_raw).strip()
-    match = re.match(r"(\d+)", s)
-    if match:
-        year = int(match.group(1))
-        if year < 100:
-            return year + 1
-        else:
-            return (year // 100) + 1
-    return None
+def token_count_of(text):
+    """
+    Count alphanumeric tokens in text without building the list of tokens.
+    """
+    return sum(1 for _ in _TOKEN_RE.finditer(text)) if text else 0
 
-def list_all_json_files(base_dir):
+def read_json_file(filepath):
     """
-    Recursively finds all JSON files under base_dir and returns a list of full paths.
+    Reads the start_year and the file_entries (pages) of a JSON file.
+    Small files are parsed at once with pages_index.load_json.
+    Larger files are streamed with ijson, so that only one file_entry at a time
+    is held in memory: a first pass finds start_year (and checks the whole file
+    is valid JSON), then the file_entries are yielded one by one.
+
+    Returns:
+        (start_year, file_entries)
     """
-    all_files = []
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            if file.endswith(".json"):
-                all_files.append(os.path.join(root, file))
-    return all_files
+    if os.path.getsize(filepath) < STREAM_THRESHOLD:
+        doc = load_json(filepath)
+        return doc.get("start_year"), doc.get("files", [])
 
-def tokenize(text):
+    # The parser backend picks start_year out of the stream itself (with the C backend,
+    # no Python code runs per JSON event); going through the whole file checks it is valid
+    with open(filepath, "rb") as f:
+        start_years = list(ijson.items(f, "start_year"))
+    start_year = start_years[-1] if start_years else None
+    return start_year, stream_file_entries(filepath)
+
+def stream_file_entries(filepath):
     """
-    Simple tokenizer: split text into alphanumeric tokens.
+    Yields the file_entries of a JSON file one by one with ijson.
     """
-    if not text:
-        return []
-    return re.findall(r"\w+", text)
+    with open(filepath, "rb") as f:
+        yield from ijson.items(f, "files.item")
 
 def process_json_file(filepath):
     """
-    Reads a single JSON file and computes:
+    Reads a single JSON file and computes, over the file_entries (pages) with a MainZone:
     - Average number of MainZone per file_entry
     - Average number of MarginTextZone per file_entry
-    - Average number of zones per file_entry
+    - Average number of GraphicZone per file_entry
+    - Average number of zones per file_entry (MainZone, MarginTextZone, GraphicZone, DropCapitalZone)
     - Average number of tokens per file_entry (from content of lines)
     
     If wh[0] > wh[1], all counts and tokens are halved.
     
     Returns:
-        (century, avg_main, avg_margin, avg_graphic, avg_total, avg_tokens) 
-        or None if start_year is invalid.
+        (century, averages) with averages an array in the order of METRICS,
+        or None if start_year is invalid or no file_entry has a MainZone.
     """
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            doc = json.load(f)
-    except Exception as e:
+        start_year, file_entries = read_json_file(filepath)
+    except (OSError, json.JSONDecodeError, UnicodeDecodeError, ijson.JSONError) as e:
         print(f"Error reading {filepath}: {e}")
         return None
 
     # Convert start_year to century
-    century = year_to_century(doc.get("start_year"))
+    century = year_to_century(start_year)
     if century is None:
         return None
 
-    # Initialize per-file counters
-    files_with_main = files_with_margin = files_with_any = files_with_graphic = files_with_drop = files_with_tokens = 0
-    total_main = total_margin = total_graphic = total_any = total_tokens = 0.0
-
-    for file_entry in doc.get("files", []):
+    # Raw counts and size per page, in the order (main, margin, graphic, drop, tokens, w, h)
+    page_rows = []
+    add_row = page_rows.append
+    for file_entry in file_entries:
         zones = file_entry.get("zones", [])
-        main_count = sum(1 for z in zones if z.get("type") == "MainZone")
-        margin_count = sum(1 for z in zones if z.get("type") == "MarginTextZone")
-        graphic_count = sum(1 for z in zones if z.get("type") == "GraphicZone")
-        drop_count = sum(1 for z in zones if z.get("type") == "DropCapitalZone")
-        any_count = len(zones)
+        # Count the zone types in a single plain loop (cheaper than a Counter or a type -> index
+        # dict on a few zones: MainZone, the most common type, is matched by the first compare)
+        main_count = margin_count = graphic_count = drop_count = 0
+        for z in zones:
+            ztype = z.get("type")
+            if ztype == "MainZone":
+                main_count += 1
+            elif ztype == "MarginTextZone":
+                margin_count += 1
+            elif ztype == "GraphicZone":
+                graphic_count += 1
+            elif ztype == "DropCapitalZone":
+                drop_count += 1
+        # We only take into consideration pages with a MainZone (exclude empty pages, title pages…),
+        # so skip the other pages before tokenizing anything
+        if main_count == 0:
+            continue
 
         # 🔹 New calculation: token count
-        token_count = 0
-        for z in zones:
-            for line in z.get("lines", []):
-                content = line.get("content", "")
-                token_count += len(tokenize(content))
+        # Tokens never span whitespace, so tokenizing the joined text once
+        # gives the same count as tokenizing each line separately
+        contents = [line.get("content") or "" for z in zones for line in z.get("lines", [])]
+        token_count = token_count_of(" ".join(contents))
 
-        # Halve counts if width > height
         wh = file_entry.get("wh", [])
-        if len(wh) == 2 and wh[0] > wh[1]:
-            main_count *= 0.5
-            margin_count *= 0.5
-            graphic_count *= 0.5
-            drop_count *= 0.5
-            any_count *= 0.5
-            token_count *= 0.5
-
-        # Aggregate counts per file_entry.
-        # We only take into consideration pages with a MainZone (exclude empty pages, title pages…)
-        if main_count > 0:
-            files_with_main += 1
-            total_main += main_count
-        if main_count > 0:
-            files_with_margin += 1
-            total_margin += margin_count
-        if main_count > 0:
-            files_with_graphic += 1
-            total_graphic += graphic_count
-        if main_count > 0:
-            files_with_any += 1
-            total = main_count + margin_count + graphic_count + drop_count
-            total_any += total
-        if main_count > 0:
-            files_with_tokens += 1
-            total_tokens += token_count
-
-    avg_main = total_main / files_with_main if files_with_main > 0 else None
-    avg_margin = total_margin / files_with_margin if files_with_margin > 0 else None
-    avg_graphic = total_graphic / files_with_graphic if files_with_graphic > 0 else None
-    avg_total = total_any / files_with_any if files_with_any > 0 else None
-    avg_tokens = total_tokens / files_with_tokens if files_with_tokens > 0 else None
-
-    return (century, avg_main, avg_margin, avg_graphic, avg_total, avg_tokens)
-
-def polynomial_smooth(x, y, degree=POLY_DEGREE):
+        w, h = wh if len(wh) == 2 else (0, 0)  # pages without a valid size are never halved
+        add_row((main_count, margin_count, graphic_count, drop_count, token_count, w, h))
+
+    if not page_rows:
+        return None
+    return (century, aggregate_pages(np.array(page_rows, dtype=np.float64)))
+
+def aggregate_pages(page_rows):
+    """
+    Average the raw counts of the pages of a file, in a few array operations.
+    page_rows holds one (main, margin, graphic, drop, tokens, w, h) row per page;
+    the counts and tokens of the pages with w > h are halved.
+    Returns the averages in the order of METRICS.
+    """
+    page_counts, (w, h) = page_rows[:, :5], page_rows[:, 5:].T
+    page_counts = page_counts * np.where(w > h, 0.5, 1.0)[:, None]
+    main, margin, graphic, drop, tokens = page_counts.mean(axis=0)
+    return np.array([main, margin, graphic, main + margin + graphic + drop, tokens])
+
+def polynomial_smooth(x, y, degree=POLY_DEGREE, weights=None):
     """
     Fit a polynomial of given degree to (x, y) data and return smoothed values.
+    y can be a 2D array with one column per series: all columns are fitted at once.
+    If each y is the mean of n points sharing the same x, passing weights=n
+    gives the same fit as on the individual points.
+    """
+    x = np.asarray(x, dtype=float)
+    w = np.sqrt(weights) if weights is not None else None
+    # n points are fitted exactly by a polynomial of degree n - 1
+    degree = min(degree, len(x) - 1)
+    # Fit on x mapped onto [-1, 1], as Polynomial.fit does: raising raw century numbers
+    # to the 6th power gives a badly conditioned Vandermonde matrix.
+    # A single century has a zero-width domain and is only shifted to 0.
+    lo, hi = pu.getdomain(x)
+    t = pu.mapdomain(x, [lo, hi], [-1, 1]) if hi > lo else x - lo
+    coeffs = P.polyfit(t, y, degree, w=w)
+    # Horner evaluation; gives one row per series, transposed back to one column per series
+    return P.polyval(t, coeffs).T
+
+def build_file_table(base_dir, use_cache=True):
+    """
+    Process all JSON files under base_dir in parallel.
+    Returns a 2D array with one row per parsed file: century, then the averages in the order of METRICS.
+
+    The table is cached in "<base_dir>.counts.npz" and reused as long as the cache
+    is newer than every JSON file and folder under base_dir, and was written with
+    the same CACHE_FORMAT and METRICS.
     """
-    poly = np.poly1d(np.polyfit(x, y, deg=degree))
-    return poly(x)
+    cache_path = f"{os.path.normpath(base_dir)}.counts.npz"
+    columns = ["century", *METRICS]
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) > latest_mtime(base_dir):
+        with np.load(cache_path) as cached:
+            # A cache written with another format or other METRICS is ignored and rebuilt
+            if set(cached.files) == {"format", *columns} and cached["format"] == CACHE_FORMAT:
+                print(f"Loading per-file averages from cache: {cache_path}")
+                return np.column_stack([cached[name] for name in columns])
+
+    all_json_files = list(list_all_json_files(base_dir))
+    print(f"Total JSON files found: {len(all_json_files)}")
+
+    # One row per file: century, then the averages in the order of METRICS (NaN if the file is skipped)
+    table = np.full((len(all_json_files), len(columns)), np.nan)
+    with json_executor(MAX_WORKERS) as ex:
+        results = with_readahead(ex.map(process_json_file, all_json_files, chunksize=CHUNKSIZE), all_json_files)
+        for i, result in enumerate(tqdm(results, total=len(all_json_files), desc="Processing JSON files", mininterval=0.5)):
+            if result:
+                table[i, 0], table[i, 1:] = result
+    table = table[~np.isnan(table[:, 0])]  # drop the skipped files
+
+    if use_cache:
+        np.savez(cache_path, format=CACHE_FORMAT, **{name: table[:, j] for j, name in enumerate(columns)})
+
+    return table
 
 # ---------------------------
 # MAIN SCRIPT
 # ---------------------------
 
-# Step 1: List all JSON files
-all_json_files = list_all_json_files(BASE_DIR)
-print(f"Total JSON files found: {len(all_json_files)}")
-
-# Step 2: Process JSON files with progress bar
-data_main = []
-data_margin = []
-data_graphic = []
-data_total = []
-data_tokens = []
-
-for filepath in tqdm(all_json_files, desc="Processing JSON files"):
-    result = process_json_file(filepath)
-    if result:
-        century, avg_main, avg_margin, avg_graphic, avg_total, avg_tokens = result
-        if avg_main is not None: data_main.append((century, avg_main))
-        if avg_margin is not None: data_margin.append((century, avg_margin))
-        if avg_graphic is not None: data_graphic.append((century, avg_graphic))
-        if avg_total is not None: data_total.append((century, avg_total))
-        if avg_tokens is not None: data_tokens.append((century, avg_tokens))
-
-# Step 3: Create DataFrames and sort by century
-df_main = pd.DataFrame(data_main, columns=["century", "avg_mainzone"]).sort_values("century").reset_index(drop=True)
-df_margin = pd.DataFrame(data_margin, columns=["century", "avg_margin"]).sort_values("century").reset_index(drop=True)
-df_graphic = pd.DataFrame(data_graphic, columns=["century", "avg_graphic"]).sort_values("century").reset_index(drop=True)
-df_total = pd.DataFrame(data_total, columns=["century", "avg_total"]).sort_values("century").reset_index(drop=True)
-df_tokens = pd.DataFrame(data_tokens, columns=["century", "avg_tokens"]).sort_values("century").reset_index(drop=True)
-
-# Step 4: Optionally save CSV
-if SAVE_CSV:
-    df_csv = df_main.merge(df_margin, on="century", how="outer")\
-                    .merge(df_graphic, on="century", how="outer")\
-                    .merge(df_total, on="century", how="outer")\
-                    .merge(df_tokens, on="century", how="outer")
-    df_csv.to_csv(CSV_OUTPUT, index=False, encoding="utf-8")
-    print(f"✅ CSV saved: {CSV_OUTPUT}")
-else:
-    print("ℹ️ CSV saving skipped.")
-
-# Step 5: Smooth curves using polynomial regression
-y_main_smooth = polynomial_smooth(df_main["century"].values, df_main["avg_mainzone"].values)
-y_margin_smooth = polynomial_smooth(df_margin["century"].values, df_margin["avg_margin"].values)
-y_graphic_smooth = polynomial_smooth(df_graphic["century"].values, df_graphic["avg_graphic"].values)
-y_total_smooth = polynomial_smooth(df_total["century"].values, df_total["avg_total"].values)
-y_tokens_smooth = polynomial_smooth(df_tokens["century"].values, df_tokens["avg_tokens"].values)
-
-# Step 6: Plot with dual y-axes
-fig, ax1 = plt.subplots(figsize=(3.25, 3.3))  # small format to fit two-columns layout
-
-# Left y-axis: zones
-ax1.set_xlabel("Century")
-ax1.set_ylabel("Zones/page (avg)")
-ax1.plot(df_main["century"], y_main_smooth, color="red", linewidth=2, label="MainZone")
-ax1.plot(df_margin["century"], y_margin_smooth, color="orange", linewidth=2, label="MarginTextZone")
-ax1.plot(df_graphic["century"], y_graphic_smooth, color="pink", linewidth=2, label="GraphicZone")
-ax1.plot(df_total["century"], y_total_smooth, color="brown", linewidth=2, label="TotalZones")
-ax1.tick_params(axis="y", labelcolor="black")
-ax1.grid(True, linestyle="--", alpha=0.5)
-
-# Right y-axis: tokens
-ax2 = ax1.twinx()
-ax2.set_ylabel("Tokens/page (avg)")
-ax2.plot(df_tokens["century"], y_tokens_smooth, color="black", linewidth=2, label="Tokens")
-ax2.tick_params(axis="y", labelcolor="black")
-
-# Combined legend
-lines1, labels1 = ax1.get_legend_handles_labels()
-lines2, labels2 = ax2.get_legend_handles_labels()
-ax1.legend(lines1 + lines2, labels1 + labels2, loc="upper left", fontsize=7)
-
-plt.title("Zones and Tokens per Century (Polyn. reg.)", fontsize=9)
-fig.tight_layout()
-plt.savefig("graph.pdf", bbox_inches="tight")  # ✅ vectoriel pour LaTeX
-print("✅ Figure saved: graph.pdf")
-plt.show()
\ No newline at end of file
+if __name__ == "__main__":
+    # Step 1: Process the JSON files in parallel, or load their averages from the cache of a previous run
+    table = build_file_table(BASE_DIR, use_cache=USE_CACHE)
+
+    # Step 2: Average files per century
+    df_files = pd.DataFrame(
+        table[:, 1:],
+        columns=METRICS,
+        index=pd.Index(table[:, 0].astype(int), name="century")
+    )
+    by_century = df_files.groupby(level="century", sort=True)
+    df = by_century.mean().add_prefix("avg_")
+    n_files = by_century.size().values
+    centuries = df.index.values
+
+    # Step 3: Optionally save CSV
+    if SAVE_CSV:
+        np.savetxt(
+            CSV_OUTPUT,
+            np.column_stack((centuries, df.values)),
+            fmt=["%d"] + ["%s"] * len(df.columns),  # %s writes the shortest repr of each float
+            delimiter=",",
+            header=",".join(["century", *df.columns]),
+            comments="",
+            encoding="utf-8"
+        )
+        print(f"✅ CSV saved: {CSV_OUTPUT}")
+    else:
+        print("ℹ️ CSV saving skipped.")
+
+    if PLOT_FIGURE:
+        import matplotlib.pyplot as plt  # imported here: slow to load and unused for CSV-only runs
+
+        # Step 4: Smooth curves using polynomial regression, all metrics in a single fit
+        # Fitting the century means weighted by their number of files is the same as fitting every file
+        smooth = pd.DataFrame(
+            polynomial_smooth(centuries, df.values, weights=n_files),
+            index=df.index,
+            columns=df.columns
+        )
+
+        # Step 5: Plot with dual y-axes
+        fig, ax1 = plt.subplots(figsize=(3.25, 3.3))  # small format to fit two-columns layout
+
+        # Left y-axis: zones
+        ax1.set_xlabel("Century")
+        ax1.set_ylabel("Zones/page (avg)")
+        ax1.plot(centuries, smooth["avg_mainzone"], color="red", linewidth=2, label="MainZone")
+        ax1.plot(centuries, smooth["avg_margin"], color="orange", linewidth=2, label="MarginTextZone")
+        ax1.plot(centuries, smooth["avg_graphic"], color="pink", linewidth=2, label="GraphicZone")
+        ax1.plot(centuries, smooth["avg_total"], color="brown", linewidth=2, label="TotalZones")
+        ax1.tick_params(axis="y", labelcolor="black")
+        ax1.grid(True, linestyle="--", alpha=0.5)
+
+        # Right y-axis: tokens
+        ax2 = ax1.twinx()
+        ax2.set_ylabel("Tokens/page (avg)")
+        ax2.plot(centuries, smooth["avg_tokens"], color="black", linewidth=2, label="Tokens")
+        ax2.tick_params(axis="y", labelcolor="black")
+
+        # Combined legend
+        lines1, labels1 = ax1.get_legend_handles_labels()
+        lines2, labels2 = ax2.get_legend_handles_labels()
+        ax1.legend(lines1 + lines2, labels1 + labels2, loc="upper left", fontsize=7)
+
+        plt.title("Zones and Tokens per Century (Polyn. reg.)", fontsize=9)
+        fig.tight_layout()
+        plt.savefig("graph.pdf", bbox_inches="tight")  # ✅ vectoriel pour LaTeX
+        print("✅ Figure saved: graph.pdf")
+        plt.show()
+    else:
+        print("ℹ️ Figure skipped.")